@@ -0,0 +1,191 @@
+import os
+import pickle
+import asyncio
+
+import cache
+import http_client
+import singleflight
+
+
+# Resource blobs are named by a hexcode that identifies their content, so a
+# stored blob never goes stale; it only stops being referenced.
+resource_store = cache.DiskCache(
+    "resources", maxbytes=int(os.environ.get("RESOURCE_STORE_BYTES", 4 << 30))
+)
+
+# Manifest types: (file name, asset name prefix, asset name suffix). Assets in
+# manifests with a prefix are keyed by the numeric id between the prefix and
+# suffix, and the others by their full name.
+MANIFESTS = {
+    "card": ("card_assetmanifest", "card_", "0.unity3d"),
+    "sleeve": ("sleeve_assetmanifest", "card_sleeve_", ".unity3d"),
+    "voice": ("soundmanifest", "v/vo_", ".acb"),
+    "master": ("master_assetmanifest", None, None),
+}
+
+# Bumped when the parsed manifests saved on disk change
+MANIFEST_VERSION = 2
+
+_manifests = {}
+
+# Per bundle hexcode: an index of the bundle's objects, and the number of
+# decodes from it and the total time they took.
+bundle_info = cache.LRUCache(int(os.environ.get("BUNDLE_INFO_SIZE", 4096)))
+decode_stats = dict(decodes=0, indexed=0, seconds=0.0)
+
+
+async def get_manifest(kind: str) -> dict:
+    """Get a manifest for the current RES_VER, as a dict of asset id (or name,
+    for manifests keyed by name) to hexcode.
+
+    Parsed manifests are saved on disk, so they are only downloaded once per
+    RES_VER.
+    """
+    manifest = _manifests.get(kind)
+    if manifest is None:
+        manifest = await singleflight.do(("manifest", kind), _load_manifest, kind)
+    return manifest
+
+
+async def get_hexcode(kind: str, key) -> str:
+    """Look up an asset's hexcode by id (or name), or None if it doesn't exist."""
+    manifest = await get_manifest(kind)
+    return manifest.get(key)
+
+
+def _manifest_path(kind: str) -> str:
+    res_ver = os.environ["RES_VER"]
+    return cache.path(f"manifest{MANIFEST_VERSION}_{res_ver}_{kind}.pickle")
+
+
+async def _load_manifest(kind: str) -> dict:
+    loop = asyncio.get_running_loop()
+    manifest_path = _manifest_path(kind)
+    try:
+        with open(manifest_path, "rb") as f:
+            manifest = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        manifest = await _download_manifest(kind)
+        data = pickle.dumps(manifest, protocol=pickle.HIGHEST_PROTOCOL)
+        await loop.run_in_executor(None, cache.write_atomic, manifest_path, data)
+    _manifests[kind] = manifest
+    return manifest
+
+
+async def _download_manifest(kind: str) -> dict:
+    name, prefix, suffix = MANIFESTS[kind]
+    res_ver = os.environ["RES_VER"]
+    url = f"https://shadowverse.akamaized.net/dl/Manifest/{res_ver}/Eng/Windows/{name}"
+
+    ret = {}
+
+    def parse_line(line: bytes):
+        fields = line.rstrip(b"\r").decode().split(",")
+        if len(fields) < 2:
+            return
+        [asset_name, hexcode, *_] = fields
+        if prefix is None:
+            ret[asset_name] = hexcode
+            return
+
+        if not (asset_name.startswith(prefix) and asset_name.endswith(suffix)):
+            return
+        asset_id = asset_name[len(prefix) : -len(suffix)]
+
+        if not asset_id.isdigit():
+            return
+        ret[int(asset_id)] = hexcode
+
+    # parse lines as they arrive, rather than buffering the whole manifest
+    session = http_client.session()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        rest = b""
+        async for chunk in response.content.iter_chunked(1 << 16):
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                parse_line(line)
+        parse_line(rest)
+
+    return ret
+
+
+async def get_resource(hexcode: str) -> bytes:
+    """Get a resource blob by hexcode, or None if it can't be downloaded."""
+    if not cache.asset_cache_rendered:
+        data = cache.asset_cache.get(("resource", hexcode))
+        if data is not None:
+            return data
+    return await singleflight.do(("resource", hexcode), _fetch_resource, hexcode)
+
+
+async def _fetch_resource(hexcode: str) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, resource_store.get, hexcode)
+    if data is None:
+        url = f"https://shadowverse.akamaized.net/dl/Resource/Eng/Windows/{hexcode}"
+        session = http_client.session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                return None
+            data = await response.read()
+        await loop.run_in_executor(None, resource_store.put, hexcode, data)
+    if not cache.asset_cache_rendered:
+        cache.asset_cache.put(("resource", hexcode), data)
+    return data
+
+
+async def collect_garbage() -> int:
+    """Delete stored resources that no current manifest refers to.
+
+    Returns the number of resources deleted.
+    """
+    referenced = set()
+    for kind in MANIFESTS:
+        referenced.update((await get_manifest(kind)).values())
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, resource_store.retain, referenced)
+
+
+def index_bundle(bundle) -> list:
+    """List the objects in a unity bundle, in order.
+
+    Each entry has the object's type, position (asset number, path_id and
+    data offset), and for textures, its name and dimensions.
+    """
+    index = []
+    for asset_number, asset in enumerate(bundle.assets):
+        for path_id, obj in asset.objects.items():
+            entry = dict(
+                type=obj.type,
+                asset=asset_number,
+                path_id=path_id,
+                offset=obj.data_offset,
+                name=None,
+                width=None,
+                height=None,
+            )
+            if obj.type == "Texture2D":
+                d = obj.read()
+                entry.update(name=d.name, width=d.width, height=d.height)
+            index.append(entry)
+    return index
+
+
+def read_object(bundle, entry: dict):
+    """Read the object for an index entry from its bundle."""
+    return bundle.assets[entry["asset"]].objects[entry["path_id"]].read()
+
+
+def record_decode(hexcode: str, index: list, seconds: float):
+    """Remember a bundle's index, and how long a decode from it took."""
+    info = bundle_info.get(hexcode)
+    if info is None:
+        info = dict(index=index, decodes=0, seconds=0.0)
+        bundle_info.put(hexcode, info)
+        decode_stats["indexed"] += 1
+    info["decodes"] += 1
+    info["seconds"] += seconds
+    decode_stats["decodes"] += 1
+    decode_stats["seconds"] += seconds
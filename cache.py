@@ -0,0 +1,226 @@
+import os
+import time
+import tempfile
+import threading
+import collections
+import urllib.parse
+
+cache_dir = os.environ.get("CACHE_DIR", ".cache")
+
+
+def path(name: str) -> str:
+    """Get the path of a file in the on-disk cache directory."""
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, name)
+
+
+def write_atomic(path: str, data: bytes):
+    """Write a file so that readers never see it partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used entries.
+
+    The bound is on the number of entries, the total size of the values as
+    measured by `sizeof`, or both. With a `ttl`, entries also expire that many
+    seconds after they are inserted.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(
+        self, maxsize: int = None, maxbytes: int = None, sizeof=len, ttl: float = None
+    ):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Look up a key, marking it as recently used."""
+        with self._lock:
+            try:
+                value, size, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and time.monotonic() >= expires:
+                del self._data[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert a key, evicting old entries if the cache is full."""
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data[key][1]
+            self._data[key] = (value, size, expires)
+            self._data.move_to_end(key)
+            self._bytes += size
+            while self._data and (
+                (self.maxsize is not None and len(self._data) > self.maxsize)
+                or (self.maxbytes is not None and self._bytes > self.maxbytes)
+            ):
+                _, (_, size, _) = self._data.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Get the cache's size and hit/miss/eviction counters."""
+        with self._lock:
+            ret = dict(
+                entries=len(self._data),
+                maxsize=self.maxsize,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+            if self.maxbytes is not None:
+                ret.update(bytes=self._bytes, maxbytes=self.maxbytes)
+            return ret
+
+
+class DiskCache:
+    """A directory of files, evicting the least recently used ones when their
+    total size exceeds `maxbytes`.
+
+    Safe to call from executor threads.
+    """
+
+    def __init__(self, name: str, maxbytes: int):
+        self.name = name
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._sizes = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(path(self.name), urllib.parse.quote(key, safe=""))
+
+    def _scan(self):
+        # Called with the lock held.
+        if self._sizes is not None:
+            return
+        directory = path(self.name)
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self._sizes[entry.name] = entry.stat().st_size
+        self._bytes = sum(self._sizes.values())
+
+    def get(self, key: str):
+        """Read a file's contents, or None if it is not in the cache."""
+        file_path = self._path(key)
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+            os.utime(file_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Write a file, evicting the least recently used files if over budget."""
+        file_path = self._path(key)
+        with self._lock:
+            self._scan()
+            write_atomic(file_path, data)
+            name = os.path.basename(file_path)
+            self._bytes += len(data) - self._sizes.get(name, 0)
+            self._sizes[name] = len(data)
+            if self._bytes > self.maxbytes:
+                self._evict()
+
+    def _evict(self):
+        # Called with the lock held.
+        directory = path(self.name)
+        by_age = []
+        for name in self._sizes:
+            try:
+                by_age.append((os.stat(os.path.join(directory, name)).st_mtime, name))
+            except FileNotFoundError:
+                by_age.append((0, name))
+        by_age.sort()
+        for _, name in by_age:
+            if self._bytes <= self.maxbytes:
+                break
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+            self._bytes -= self._sizes.pop(name)
+            self.evictions += 1
+
+    def retain(self, keys) -> int:
+        """Delete every file whose key is not in keys.
+
+        Returns the number of files deleted.
+        """
+        keep = {urllib.parse.quote(key, safe="") for key in keys}
+        with self._lock:
+            self._scan()
+            directory = path(self.name)
+            removed = [name for name in self._sizes if name not in keep]
+            for name in removed:
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+                self._bytes -= self._sizes.pop(name)
+            return len(removed)
+
+    def stats(self) -> dict:
+        """Get the cache's size and hit/miss/eviction counters."""
+        with self._lock:
+            self._scan()
+            return dict(
+                entries=len(self._sizes),
+                bytes=self._bytes,
+                maxbytes=self.maxbytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+# Asset bundles shared by card_art and sleeves, or with ASSET_CACHE_RENDERED set,
+# the PNGs rendered from them, which are much smaller.
+asset_cache = LRUCache(maxbytes=int(os.environ.get("ASSET_CACHE_BYTES", 128 << 20)))
+asset_cache_rendered = os.environ.get("ASSET_CACHE_RENDERED") is not None
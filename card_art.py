@@ -1,96 +1,220 @@
 import io
 import os
+import time
+import pickle
+import asyncio
 import tempfile
 
-import aiohttp
 import PIL
+import aiohttp
 import unitypack
 
-
-_assetmanifest = None
-_asset_cache = {}
+import cache
+import assets
+import http_client
+import singleflight
+import workers
+
+
+# svgdb art is cached in memory and on disk, and revalidated against svgdb
+# once it is older than ART_REVALIDATE_AFTER seconds.
+art_cache = cache.LRUCache(
+    maxbytes=int(os.environ.get("ART_CACHE_BYTES", 64 << 20)),
+    sizeof=lambda entry: len(entry["data"]),
+)
+art_store = cache.DiskCache(
+    "svgdb_art", maxbytes=int(os.environ.get("ART_STORE_BYTES", 1 << 30))
+)
+ART_REVALIDATE_AFTER = float(os.environ.get("ART_REVALIDATE_AFTER", 86400))
+# Art svgdb doesn't have, so that it isn't asked for again for a while
+missing_art = cache.LRUCache(
+    int(os.environ.get("MISSING_ART_CACHE_SIZE", 4096)),
+    ttl=float(os.environ.get("MISSING_ART_TTL", 3600)),
+)
+
+# When new cards come out, their art is fetched ahead of time, at most
+# PREWARM_CONCURRENCY at once and PREWARM_RATE requests per second.
+PREWARM_CONCURRENCY = int(os.environ.get("PREWARM_CONCURRENCY", 4))
+PREWARM_RATE = float(os.environ.get("PREWARM_RATE", 5))
+prewarm_stats = dict(runs=0, fetched=0, missing=0, failed=0)
+_prewarm_tasks = set()
 
 
 async def get_assetmanifest() -> dict:
-    global _assetmanifest
-    if _assetmanifest is not None:
-        return _assetmanifest
-
-    res_ver = os.environ["RES_VER"]
-    url = f"https://shadowverse.akamaized.net/dl/Manifest/{res_ver}/Eng/Windows/card_assetmanifest"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            text = await response.text()
-
-    ret = {}
-    for line in text.splitlines():
-        fields = line.split(",")
-        if len(fields) < 2:
-            continue
-        [name, hexcode, *_] = fields
-
-        prefix = "card_"
-        suffix = "0.unity3d"
-        if not name.startswith(prefix) and name.endswith(suffix):
-            continue
-        card_id = name[len(prefix) : -len(suffix)]
+    return await assets.get_manifest("card")
 
-        if not card_id.isdigit():
-            continue
-        card_id = int(card_id)
 
-        ret[card_id] = hexcode
+async def get_asset(card_id: int, suffix: str) -> io.BytesIO:
+    png = await _get_asset_png(card_id, suffix)
+    if png is None:
+        return None
+    return io.BytesIO(png)
 
-    _assetmanifest = ret
-    return ret
 
+async def _get_asset_png(card_id: int, suffix: str) -> bytes:
+    hexcode = await assets.get_hexcode("card", card_id)
+    if hexcode is None:
+        return None
 
-async def get_asset(card_id: int, suffix: str) -> io.BytesIO:
-    data = _asset_cache.get(card_id)
+    if cache.asset_cache_rendered:
+        png = cache.asset_cache.get(("card_art", hexcode, suffix))
+        if png is not None:
+            return png
 
+    data = await assets.get_resource(hexcode)
     if data is None:
-        manifest = await get_assetmanifest()
+        return None
+
+    info = assets.bundle_info.get(hexcode)
+    png, index, seconds = await workers.run(
+        render_asset, data, suffix, info and info["index"]
+    )
+    assets.record_decode(hexcode, index, seconds)
+    if cache.asset_cache_rendered and png is not None:
+        cache.asset_cache.put(("card_art", hexcode, suffix), png)
+    return png
 
-        hexcode = manifest.get(card_id)
-        if hexcode is None:
-            return None
 
-        url = f"https://shadowverse.akamaized.net/dl/Resource/Eng/Windows/{hexcode}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = _asset_cache[card_id] = await response.read()
+def render_asset(data: bytes, suffix: str, index: list = None) -> tuple:
+    """Extract a card's art from an asset bundle, as PNG bytes.
 
+    Only the matching texture is decoded, found using the bundle's index,
+    which is built if not given. Returns the PNG, the index, and the time
+    taken. Runs in a worker process.
+    """
+    start = time.perf_counter()
     data = io.BytesIO(data)
     data.name = ""
     bundle = unitypack.load(data)
+    if index is None:
+        index = assets.index_bundle(bundle)
 
     image = None
-    for asset in bundle.assets:
-        for _, obj in asset.objects.items():
-            if obj.type == "Texture2D":
-                d = obj.read()
-                i = d.image
-                if d.name.endswith(suffix) and d.width == d.height == 1024:
-                    image = d.image
-                    break
-        if image is not None:
+    for entry in index:
+        if (
+            entry["type"] == "Texture2D"
+            and entry["name"].endswith(suffix)
+            and entry["width"] == entry["height"] == 1024
+        ):
+            image = assets.read_object(bundle, entry).image
             break
 
-    if image is None:
-        return None
-
-    ret = io.BytesIO()
-    image = image.transpose(PIL.Image.FLIP_TOP_BOTTOM).resize((848, 1024))
-    image.save(ret, format="png")
-    ret.seek(0)
-
-    return ret
+    png = None
+    if image is not None:
+        ret = io.BytesIO()
+        image = image.transpose(PIL.Image.FLIP_TOP_BOTTOM).resize((848, 1024))
+        image.save(ret, format="png")
+        png = ret.getvalue()
+    return png, index, time.perf_counter() - start
 
 
 async def svgdb_get(card_id: int, suffix: str) -> io.BytesIO:
+    key = f"{card_id}_{suffix}"
+    entry = art_cache.get(key)
+    if entry is None or time.time() - entry["checked"] >= ART_REVALIDATE_AFTER:
+        if entry is None and missing_art.get(key):
+            return None
+        data = await singleflight.do(
+            ("svgdb_art", key), _svgdb_fetch, card_id, suffix, entry
+        )
+    else:
+        data = entry["data"]
+    if data is None:
+        return None
+    return io.BytesIO(data)
+
+
+async def _svgdb_fetch(card_id: int, suffix: str, entry: dict = None) -> bytes:
+    key = f"{card_id}_{suffix}"
+    loop = asyncio.get_running_loop()
+    if entry is None:
+        blob = await loop.run_in_executor(None, art_store.get, key)
+        if blob is not None:
+            entry = pickle.loads(blob)
+            art_cache.put(key, entry)
+    if entry is not None and time.time() - entry["checked"] < ART_REVALIDATE_AFTER:
+        return entry["data"]
+
+    try:
+        new_entry = await _svgdb_download(card_id, suffix, entry)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if entry is None:
+            raise
+        print(f"Failed to revalidate svgdb art {key}: {e!r}")
+        new_entry = None
+    if new_entry is None:
+        # Don't cache error responses, but keep serving what we have.
+        return entry["data"] if entry is not None else None
+    art_cache.put(key, new_entry)
+    blob = pickle.dumps(new_entry, protocol=pickle.HIGHEST_PROTOCOL)
+    await loop.run_in_executor(None, art_store.put, key, blob)
+    return new_entry["data"]
+
+
+async def _svgdb_download(card_id: int, suffix: str, entry: dict = None) -> dict:
     url = f"https://svgdb.me/assets/fullart/{card_id}{suffix}.png"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            data = io.BytesIO(await response.read())
-
-    return data
+    headers = {}
+    if entry is not None:
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    session = http_client.session()
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304 and entry is not None:
+            return dict(entry, checked=time.time())
+        if response.status == 404 and entry is None:
+            missing_art.put(f"{card_id}_{suffix}", True)
+        if response.status != 200:
+            return None
+        return dict(
+            data=await response.read(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            checked=time.time(),
+        )
+
+
+def on_cards_updated(old_cards: list, new_cards: list):
+    """Start pre-warming the art of cards that weren't in old_cards."""
+    old_ids = {card["card_id"] for card in old_cards}
+    cards = [card for card in new_cards if card["card_id"] not in old_ids]
+    if cards:
+        task = asyncio.ensure_future(prewarm(cards))
+        _prewarm_tasks.add(task)
+        task.add_done_callback(_prewarm_tasks.discard)
+
+
+async def prewarm(cards: list):
+    """Fetch the base and evolved art of cards into the art cache."""
+    # evolved art only exists for followers
+    jobs = [(card["card_id"], "0") for card in cards]
+    jobs += [(card["card_id"], "1") for card in cards if card["char_type"] == 1]
+    print(f"Pre-warming art for {len(cards)} new cards")
+    prewarm_stats["runs"] += 1
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+    next_start = loop.time()
+
+    async def fetch(card_id: int, suffix: str):
+        nonlocal next_start
+        async with semaphore:
+            # space out the requests to stay under the rate limit
+            now = loop.time()
+            delay = next_start - now
+            next_start = max(now, next_start) + 1 / PREWARM_RATE
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                image = await svgdb_get(card_id, suffix)
+            except Exception as e:
+                prewarm_stats["failed"] += 1
+                print(f"Failed to pre-warm art for {card_id}{suffix}: {e!r}")
+                return
+            if image is None:
+                prewarm_stats["missing"] += 1
+            else:
+                prewarm_stats["fetched"] += 1
+
+    await asyncio.gather(*(fetch(card_id, suffix) for card_id, suffix in jobs))
@@ -1,54 +1,20 @@
 import io
-import os
 import tempfile
 
-import aiohttp
-
+import assets
 import card_data
-
-
-_soundmanifest = None
+import http_client
 
 
 async def get_soundmanifest() -> dict:
-    global _soundmanifest
-    if _soundmanifest is not None:
-        return _soundmanifest
-
-    res_ver = os.environ["RES_VER"]
-    url = f"https://shadowverse.akamaized.net/dl/Manifest/{res_ver}/Eng/Windows/soundmanifest"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            text = await response.text()
-
-    ret = {}
-    for line in text.splitlines():
-        fields = line.split(",")
-        if len(fields) < 2:
-            continue
-        [name, hexcode, *_] = fields
-
-        prefix = "v/vo_"
-        suffix = ".acb"
-        if not name.startswith(prefix) and name.endswith(suffix):
-            continue
-        card_id = name[len(prefix) : -len(suffix)]
-
-        if not card_id.isdigit():
-            continue
-        card_id = int(card_id)
-
-        ret[card_id] = hexcode
-
-    _soundmanifest = ret
-    return ret
+    return await assets.get_manifest("voice")
 
 
 async def svgdb_get(card_id: int) -> list:
     url = f"https://svgdb.me/api/voices/{card_id}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            json = await response.json()
+    session = http_client.session()
+    async with session.get(url) as response:
+        json = await response.json()
 
     ret = []
     for label, basenames in json.items():
@@ -1,34 +1,186 @@
-import aiohttp
+import os
+import re
+import asyncio
 
+import cache
 import card_data
+import http_client
+import singleflight
+
+
+# A deck hash is "<format>.<clan>.<card>.<card>...", where each card is its
+# card id in base 64, written with 5 characters of this alphabet.
+HASH_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_"
+_hash_pattern = re.compile(r"\d+\.\d+(\.[0-9A-Za-z_-]{5})+")
+_url_pattern = re.compile(r"shadowverse-portal\.com/deck/([0-9A-Za-z_.-]+)")
+
+_cards_by_id = (None, {})
+
+# Deck codes are only valid for a short while, but a deck hash always means the
+# same deck.
+code_cache = cache.LRUCache(
+    int(os.environ.get("DECK_CODE_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("DECK_CODE_TTL", 600)),
+)
+deck_cache = cache.LRUCache(int(os.environ.get("DECK_CACHE_SIZE", 1024)))
+embed_cache = cache.LRUCache(int(os.environ.get("DECK_CACHE_SIZE", 1024)))
+
+# How many deck codes in a batch are looked up at once, and at most in total
+DECK_BATCH_CONCURRENCY = int(os.environ.get("DECK_BATCH_CONCURRENCY", 4))
+DECK_BATCH_MAX = int(os.environ.get("DECK_BATCH_MAX", 64))
+
+# Decks decoded locally, and downloaded because they had unknown cards. A
+# downloaded deck whose cards don't match decode_hash means the local decoder
+# is wrong, and every lookup is paying for a download.
+decode_stats = dict(decoded=0, downloaded=0, mismatched=0)
 
 
 async def get(code: str) -> dict:
-    """Look up a deck code."""
-    async with aiohttp.ClientSession() as session:
-        url = (
-            "https://shadowverse-portal.com/api/v1/deck/import"
-            f"?format=json&deck_code={code}"
-        )
-        async with session.get(url) as response:
-            json = await response.json()
-            if json["data"]["errors"]:
-                return {"errors": json["data"]["errors"]}
-            h = json["data"]["hash"]
-
-        url = (
-            "https://shadowverse-portal.com/api/v1/deck"
-            f"?format=json&lang=en&hash={h}"
-        )
-        async with session.get(url) as response:
-            json = await response.json()
-            deck = json["data"]["deck"]
+    """Look up a deck code, a deck hash, or a shadowverse-portal deck URL."""
+    h = parse_hash(code)
+    if h is None:
+        h = code_cache.get(code)
+    if h is None:
+        result = await singleflight.do(("deck_code", code), _import, code)
+        if result.get("errors"):
+            return result
+        h = result["hash"]
+        code_cache.put(code, h)
+    return await get_deck(h)
+
+
+async def get_many(codes: list) -> list:
+    """Look up several deck codes concurrently.
+
+    Returns the results in order. A lookup that raised an exception gives the
+    exception as its result, so one bad code doesn't stop the others.
+    """
+    semaphore = asyncio.Semaphore(DECK_BATCH_CONCURRENCY)
+
+    async def get_one(code: str) -> dict:
+        async with semaphore:
+            return await get(code)
+
+    return await asyncio.gather(
+        *(get_one(code) for code in codes), return_exceptions=True
+    )
+
+
+async def _import(code: str) -> dict:
+    session = http_client.session()
+    url = (
+        "https://shadowverse-portal.com/api/v1/deck/import"
+        f"?format=json&deck_code={code}"
+    )
+    async with session.get(url) as response:
+        json = await response.json()
+        if json["data"]["errors"]:
+            return {"errors": json["data"]["errors"]}
+        return {"hash": json["data"]["hash"]}
+
 
+def parse_hash(text: str) -> str:
+    """Get the deck hash from a deck URL or a bare deck hash.
+
+    Returns None if the text is neither, e.g. for a deck code.
+    """
+    m = _url_pattern.search(text)
+    if m is not None:
+        return m.group(1)
+    if _hash_pattern.fullmatch(text):
+        return text
+    return None
+
+
+def decode_hash(h: str) -> (int, int, list):
+    """Decode a deck hash into its format, clan and list of card ids.
+
+    Raises ValueError if the hash is malformed.
+    """
+    if not _hash_pattern.fullmatch(h):
+        raise ValueError(f"invalid deck hash: {h!r}")
+    [deck_format, clan, *cards] = h.split(".")
+    card_ids = []
+    for card in cards:
+        card_id = 0
+        for c in card:
+            card_id = card_id * 64 + HASH_ALPHABET.index(c)
+        card_ids.append(card_id)
+    return int(deck_format), int(clan), card_ids
+
+
+def decode_deck(h: str, cards: list) -> dict:
+    """Decode a deck hash into a deck, using card info from `cards`.
+
+    Returns None if the hash is malformed or has cards not in `cards`.
+    """
+    global _cards_by_id
+    try:
+        deck_format, clan, card_ids = decode_hash(h)
+    except ValueError:
+        return None
+    if clan >= len(card_data.crafts):
+        return None
+
+    if _cards_by_id[0] is not cards:
+        _cards_by_id = (cards, {card["card_id"]: card for card in cards})
+    by_id = _cards_by_id[1]
+    if not all(card_id in by_id for card_id in card_ids):
+        return None
+    return dict(
+        deck_format=deck_format,
+        clan=clan,
+        cards=[by_id[card_id] for card_id in card_ids],
+    )
+
+
+async def get_deck(h: str) -> dict:
+    """Look up a deck hash, decoding it locally if all its cards are known."""
+    result = deck_cache.get(h)
+    if result is not None:
+        return result
+    deck = decode_deck(h, await card_data.get())
+    if deck is not None:
+        decode_stats["decoded"] += 1
+        result = {"hash": h, "deck": deck}
+    else:
+        result = await singleflight.do(("deck_hash", h), _download, h)
+        if result.get("errors"):
+            return result
+    deck_cache.put(h, result)
+    return result
+
+
+async def _download(h: str) -> dict:
+    session = http_client.session()
+    url = f"https://shadowverse-portal.com/api/v1/deck?format=json&lang=en&hash={h}"
+    async with session.get(url) as response:
+        json = await response.json()
+        if json["data"].get("errors"):
+            return {"errors": json["data"]["errors"]}
+        deck = json["data"]["deck"]
+
+    decode_stats["downloaded"] += 1
+    try:
+        decoded = decode_hash(h)[2]
+    except ValueError:
+        decoded = None
+    if decoded != [card["card_id"] for card in deck["cards"]]:
+        decode_stats["mismatched"] += 1
+        print(f"Deck hash {h} decodes to different cards than the portal's")
     return {"hash": h, "deck": deck}
 
 
 def embed(data: dict) -> dict:
     """Generate an embed for a deck."""
+    ret = embed_cache.get(data["hash"])
+    if ret is None:
+        ret = _embed(data)
+        embed_cache.put(data["hash"], ret)
+    return ret
+
+
+def _embed(data: dict) -> dict:
     title = card_data.crafts[data["deck"]["clan"]]
 
     counts = {}
@@ -0,0 +1,100 @@
+import io
+import os
+import asyncio
+
+import PIL.Image
+import PIL.ImageDraw
+
+import cache
+import card_art
+import singleflight
+import workers
+
+
+# Card art is 848x1024; tiles keep its aspect ratio
+TILE_SIZE = (106, 128)
+COLUMNS = 8
+
+# Thumbnails keyed by (card_id, size), and finished deck images by deck hash
+thumbnail_cache = cache.LRUCache(
+    maxbytes=int(os.environ.get("DECK_THUMBNAIL_CACHE_BYTES", 16 << 20))
+)
+image_cache = cache.LRUCache(
+    maxbytes=int(os.environ.get("DECK_IMAGE_CACHE_BYTES", 32 << 20))
+)
+
+
+async def render(data: dict) -> bytes:
+    """Render a deck from deck_code.get as a grid of card art, as PNG bytes."""
+    h = data["hash"]
+    png = image_cache.get(h)
+    if png is None:
+        png = await singleflight.do(("deck_image", h), _render, data)
+    return png
+
+
+async def _render(data: dict) -> bytes:
+    counts = {}
+    for card in data["deck"]["cards"]:
+        counts[card["card_id"]] = counts.get(card["card_id"], 0) + 1
+
+    thumbnails = await asyncio.gather(
+        *(get_thumbnail(card_id, TILE_SIZE) for card_id in counts),
+        return_exceptions=True,
+    )
+    # a card whose art can't be fetched or scaled gets a blank tile
+    for i, (card_id, thumbnail) in enumerate(zip(counts, thumbnails)):
+        if isinstance(thumbnail, Exception):
+            print(f"Failed to get thumbnail for card {card_id}: {thumbnail!r}")
+            thumbnails[i] = None
+    tiles = list(zip(thumbnails, counts.values()))
+    png = await workers.run(composite, tiles, TILE_SIZE, COLUMNS)
+    image_cache.put(data["hash"], png)
+    return png
+
+
+async def get_thumbnail(card_id: int, size: tuple) -> bytes:
+    """Get a card's base art scaled to `size`, as PNG bytes, or None if the
+    card has no art."""
+    key = (card_id, size)
+    thumbnail = thumbnail_cache.get(key)
+    if thumbnail is None:
+        art = await card_art.svgdb_get(card_id, "0")
+        if art is None:
+            return None
+        thumbnail = await workers.run(make_thumbnail, art.getvalue(), size)
+        thumbnail_cache.put(key, thumbnail)
+    return thumbnail
+
+
+def make_thumbnail(data: bytes, size: tuple) -> bytes:
+    """Scale an image to `size`, as PNG bytes. Runs in a worker process."""
+    image = PIL.Image.open(io.BytesIO(data)).convert("RGB")
+    image = image.resize(size, PIL.Image.LANCZOS)
+    ret = io.BytesIO()
+    image.save(ret, format="png")
+    return ret.getvalue()
+
+
+def composite(tiles: list, size: tuple, columns: int) -> bytes:
+    """Lay out (thumbnail, count) pairs in a grid, as PNG bytes.
+
+    Cards without a thumbnail get a blank tile. Runs in a worker process.
+    """
+    width, height = size
+    rows = (len(tiles) + columns - 1) // columns
+    image = PIL.Image.new("RGB", (width * min(columns, len(tiles)), height * rows))
+    draw = PIL.ImageDraw.Draw(image)
+    for i, (thumbnail, count) in enumerate(tiles):
+        x = width * (i % columns)
+        y = height * (i // columns)
+        if thumbnail is not None:
+            image.paste(PIL.Image.open(io.BytesIO(thumbnail)), (x, y))
+        else:
+            draw.rectangle((x, y, x + width - 1, y + height - 1), fill=(64, 64, 64))
+        label = f"x{count}"
+        draw.rectangle((x, y + height - 16, x + 24, y + height), fill=(0, 0, 0))
+        draw.text((x + 3, y + height - 14), label, fill=(255, 255, 255))
+    ret = io.BytesIO()
+    image.save(ret, format="png")
+    return ret.getvalue()
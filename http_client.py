@@ -0,0 +1,41 @@
+import os
+import asyncio
+
+import aiohttp
+
+
+_session = None
+_session_loop = None
+
+
+def session() -> aiohttp.ClientSession:
+    """Get the HTTP session shared by all modules, creating it if needed.
+
+    The session pools connections per host and keeps them alive between
+    requests, and caches DNS lookups.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=int(os.environ.get("HTTP_LIMIT", 100)),
+            limit_per_host=int(os.environ.get("HTTP_LIMIT_PER_HOST", 10)),
+            ttl_dns_cache=int(os.environ.get("HTTP_DNS_CACHE_TTL", 300)),
+            keepalive_timeout=float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 60)),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=float(os.environ.get("HTTP_TIMEOUT", 120)),
+            connect=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10)),
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _session_loop = loop
+    return _session
+
+
+async def close():
+    """Close the shared HTTP session."""
+    global _session, _session_loop
+    if _session is not None:
+        await _session.close()
+    _session = None
+    _session_loop = None
@@ -1,21 +1,36 @@
+import io
 import os
-import asyncio
 
 import discord
 from discord.ext import commands
 
+import cache
+import assets
 import card_data
 import card_art
 import card_voice
 import sleeves
 import deck_code
+import deck_image
+import http_client
+import paginator
+import singleflight
+import workers
 
 command_prefix = os.environ["BOT_PREFIX"].split()
 
 intents = discord.Intents.default()
 intents.messages = True
 
-bot = commands.Bot(
+
+class Bot(commands.Bot):
+    async def close(self):
+        await super().close()
+        await http_client.close()
+        workers.shutdown()
+
+
+bot = Bot(
     command_prefix=command_prefix,
     description=os.environ.get("DESCRIPTION", "Shadowverse info bot"),
     intents=intents,
@@ -42,6 +57,8 @@ class DeckCodeError(Exception):
         super().__init__(deck_code, errors)
 
 
+card_data.add_update_listener(card_art.on_cards_updated)
+
 # Hack: avoid raising UnexpectedQuoteError
 commands.view._all_quotes = set()
 
@@ -49,12 +66,20 @@ commands.view._all_quotes = set()
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user}")
+    # loads the cards in the background, so a slow or failed download doesn't
+    # hold up the rest of startup
+    card_data.start_refresh(float(os.environ.get("CARD_REFRESH_INTERVAL", 3600)))
     if os.environ.get("DEV") is None:
         status = os.environ.get("STATUS", f"{command_prefix[0]}help")
         activity = discord.Game(name=status)
         await bot.change_presence(activity=activity)
 
 
+@bot.event
+async def on_raw_reaction_add(payload):
+    await paginator.on_reaction(payload)
+
+
 @bot.command()
 async def invite(ctx):
     """Generate a link to invite me to your server"""
@@ -74,57 +99,33 @@ async def cards(ctx, *query):
     - search havencraft "repair mode"
     - search legendary "steel rebellion"
 
+    Numeric fields can be compared. Examples:
+    - search cost>=7 atk<3
+    - search set:rotation craft:haven type:amulet
+
     """
 
     async with ctx.typing():
         cards = await card_data.get()
-    results = card_data.find(cards, query)
+    results = await card_data.search(cards, query)
     if not results:
         raise CardNotFoundError(query)
-    else:
-        max_results = 20
+
+    max_results = 20
+
+    def render(page: int) -> dict:
         if len(results) <= max_results:
             lines = [f"Found {len(results)} cards:"]
             lines += [card_data.effective_card_name(card) for card in results]
-            await ctx.send("\n".join(lines))
         else:
-            lo = 0
-            hi = max_results
+            lo = min(page * max_results, len(results) - max_results)
+            hi = lo + max_results
             lines = [f"Found {len(results)} cards, displaying {lo+1}-{hi}:"]
             lines += [card_data.effective_card_name(card) for card in results[lo:hi]]
-            msg = await ctx.send("\n".join(lines))
-            await msg.add_reaction("⬅️")
-            await msg.add_reaction("➡️")
-
-            def check(reaction, user):
-                return (
-                    user != bot.user
-                    and reaction.message.id == msg.id
-                    and reaction.emoji in ["➡️", "⬅️"]
-                )
-
-            while True:
-                try:
-                    reaction, usr = await bot.wait_for(
-                        "reaction_add", timeout=30.0, check=check
-                    )
-                except asyncio.TimeoutError:
-                    await msg.remove_reaction("➡️", bot.user)
-                    await msg.remove_reaction("⬅️", bot.user)
-                    break
-                else:
-                    if reaction.emoji == "➡️":
-                        hi = min(len(results), hi + max_results)
-                        lo = hi - max_results
-                    elif reaction.emoji == "⬅️":
-                        lo = max(0, lo - max_results)
-                        hi = lo + max_results
-
-                    lines = [f"Found {len(results)} cards, displaying {lo+1}-{hi}:"]
-                    lines += [
-                        card_data.effective_card_name(card) for card in results[lo:hi]
-                    ]
-                    await msg.edit(content="\n".join(lines))
+        return dict(content="\n".join(lines))
+
+    pages = (len(results) + max_results - 1) // max_results
+    await paginator.send(ctx, pages, render)
 
 
 @bot.command(aliases=["c", "text", "t"])
@@ -133,7 +134,7 @@ async def card(ctx, *query):
 
     async with ctx.typing():
         cards = await card_data.get()
-    results = card_data.find(cards, query)
+    results = await card_data.search(cards, query)
     if not results:
         raise CardNotFoundError(query)
     else:
@@ -148,7 +149,7 @@ async def flavortext(ctx, *query):
 
     async with ctx.typing():
         cards = await card_data.get()
-    results = card_data.find(cards, query)
+    results = await card_data.search(cards, query)
     if not results:
         raise CardNotFoundError(query)
     else:
@@ -163,7 +164,7 @@ async def art_gen(ctx, query: list, which: str):
     async with ctx.typing():
         cards = await card_data.get()
 
-    results = card_data.find(cards, query)
+    results = await card_data.search(cards, query)
     if not results:
         raise CardNotFoundError(query)
     result = results[0]
@@ -184,7 +185,7 @@ async def voice(ctx, *query):
     async with ctx.typing():
         cards = await card_data.get()
 
-    results = card_data.find(cards, query)
+    results = await card_data.search(cards, query)
     if not results:
         raise CardNotFoundError(query)
     result = results[0]
@@ -192,7 +193,19 @@ async def voice(ctx, *query):
     async with ctx.typing():
         embed = await card_voice.svgdb_embed(result)
 
-    await ctx.send(embed=discord.Embed.from_dict(embed))
+    # embeds hold at most 25 fields, so long voice lists span several pages
+    fields = embed["fields"]
+    max_fields = 25
+    pages = max(1, (len(fields) + max_fields - 1) // max_fields)
+
+    def render(page: int) -> dict:
+        lo = page * max_fields
+        page_embed = dict(embed, fields=fields[lo : lo + max_fields])
+        if pages > 1:
+            page_embed["footer"] = dict(text=f"Page {page+1}/{pages}")
+        return dict(embed=discord.Embed.from_dict(page_embed))
+
+    await paginator.send(ctx, pages, render)
 
 
 @bot.command(aliases=["img", "a"])
@@ -245,6 +258,75 @@ async def deckcode(ctx, code: str):
     await ctx.send(embed=embed)
 
 
+@bot.command(aliases=["deckimg", "deckart"])
+async def deckimage(ctx, code: str):
+    """Show a deck as a grid of card art."""
+
+    async with ctx.typing():
+        result = await deck_code.get(code)
+        errors = result.get("errors")
+        if errors:
+            raise DeckCodeError(code, errors)
+        image = await deck_image.render(result)
+
+    title = deck_code.embed(result)["title"]
+    await ctx.send(title, file=discord.File(io.BytesIO(image), "deck.png"))
+
+
+@bot.command(aliases=["decks", "codes"])
+async def deckcodes(ctx, *codes):
+    """Look up several deck codes at once.
+
+    Codes can be given in the command or in an attached text file.
+    """
+
+    codes = list(codes)
+    for attachment in ctx.message.attachments:
+        codes += (await attachment.read()).decode(errors="replace").split()
+    if not codes:
+        await ctx.send("No deck codes given")
+        return
+    ignored = max(0, len(codes) - deck_code.DECK_BATCH_MAX)
+    codes = codes[: deck_code.DECK_BATCH_MAX]
+
+    async with ctx.typing():
+        results = await deck_code.get_many(codes)
+
+    lines = []
+    failed = 0
+    for code, result in zip(codes, results):
+        if isinstance(result, dict) and result.get("errors"):
+            result = DeckCodeError(code, result["errors"])
+        if isinstance(result, Exception):
+            failed += 1
+            if isinstance(result, DeckCodeError):
+                lines.append(f"`{code}`: invalid or expired deck code")
+            else:
+                print(f"Failed to look up deck code {code}: {result!r}")
+                lines.append(f"`{code}`: lookup failed")
+        else:
+            embed = deck_code.embed(result)
+            count = len(result["deck"]["cards"])
+            lines.append(f"`{code}`: {embed['title']}, {count} cards <{embed['url']}>")
+
+    header = f"Looked up {len(codes)} deck codes, {failed} failed"
+    if ignored:
+        header += f" ({ignored} more ignored, the limit is {deck_code.DECK_BATCH_MAX})"
+    header += ":"
+    await send_lines(ctx, [header] + lines)
+
+
+async def send_lines(ctx, lines: list):
+    """Send lines of text, split into pages that fit in a message."""
+    pages = paginator.split_lines(lines)
+
+    def render(page: int) -> dict:
+        start, end = pages[page]
+        return dict(content="\n".join(lines[start:end]))
+
+    await paginator.send(ctx, len(pages), render)
+
+
 @bot.command(hidden=True)
 async def randomcard(ctx):
     async with ctx.typing():
@@ -260,6 +342,43 @@ async def update(ctx):
         await card_data._update()
 
 
+@bot.command(hidden=True)
+async def gc(ctx):
+    async with ctx.typing():
+        removed = await assets.collect_garbage()
+    await ctx.send(f"Removed {removed} unreferenced resources")
+
+
+@bot.command(hidden=True)
+async def stats(ctx):
+    stats = {
+        "find cache": card_data.find_cache.stats(),
+        "search": card_data.search_metrics(),
+        "art cache": card_art.art_cache.stats(),
+        "art store": card_art.art_store.stats(),
+        "missing art": card_art.missing_art.stats(),
+        "asset cache": cache.asset_cache.stats(),
+        "resource store": assets.resource_store.stats(),
+        "bundle decodes": assets.decode_stats,
+        "art prewarm": card_art.prewarm_stats,
+        "deck code cache": deck_code.code_cache.stats(),
+        "deck cache": deck_code.deck_cache.stats(),
+        "deck embed cache": deck_code.embed_cache.stats(),
+        "deck decodes": deck_code.decode_stats,
+        "deck thumbnail cache": deck_image.thumbnail_cache.stats(),
+        "deck image cache": deck_image.image_cache.stats(),
+        "workers": workers.stats,
+        "paginators": paginator.metrics(),
+    }
+    for name, group in singleflight.stats.items():
+        stats[f"{name} fetches"] = group
+    lines = [
+        f"{name}: " + ", ".join(f"{k}={v}" for k, v in values.items())
+        for name, values in stats.items()
+    ]
+    await ctx.send("```" + "\n".join(lines) + "```")
+
+
 @bot.command(hidden=True)
 async def eggsplosion(ctx):
     async with ctx.typing():
@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+
+
+PREV = "⬅️"
+NEXT = "➡️"
+
+# Seconds a paginated message stays active after it's sent or last turned
+PAGE_TTL = float(os.environ.get("PAGE_TTL", 30))
+
+# Open paginators by message id. Reactions are dispatched here from a single
+# on_raw_reaction_add handler, rather than each message waiting for its own.
+_paginators = {}
+_sweeper = None
+
+stats = dict(opened=0, turns=0, expired=0)
+
+
+class Paginator:
+    """A message whose pages can be turned with reactions.
+
+    `render(page)` returns a page's contents as keyword arguments for send and
+    edit. Pages are rendered when first shown, and kept for repeat views.
+    """
+
+    def __init__(self, count: int, render):
+        self.count = count
+        self.render = render
+        self.page = 0
+        self.pages = {}
+        self.message = None
+        self.me = None
+        self.expires = 0.0
+
+    def get_page(self, page: int) -> dict:
+        kwargs = self.pages.get(page)
+        if kwargs is None:
+            kwargs = self.pages[page] = self.render(page)
+        return kwargs
+
+    async def turn(self, emoji: str):
+        if emoji == NEXT:
+            page = min(self.count - 1, self.page + 1)
+        elif emoji == PREV:
+            page = max(0, self.page - 1)
+        else:
+            return
+        self.expires = time.monotonic() + PAGE_TTL
+        if page != self.page:
+            self.page = page
+            stats["turns"] += 1
+            await self.message.edit(**self.get_page(page))
+
+    async def close(self):
+        await self.message.remove_reaction(NEXT, self.me)
+        await self.message.remove_reaction(PREV, self.me)
+
+
+async def send(ctx, count: int, render):
+    """Send the first of `count` pages, and let users turn the pages with
+    reactions if there are more."""
+    paginator = Paginator(count, render)
+    paginator.message = await ctx.send(**paginator.get_page(0))
+    if count <= 1:
+        return paginator.message
+    paginator.me = ctx.me
+    paginator.expires = time.monotonic() + PAGE_TTL
+    _paginators[paginator.message.id] = paginator
+    stats["opened"] += 1
+    _start_sweeper()
+    await paginator.message.add_reaction(PREV)
+    await paginator.message.add_reaction(NEXT)
+    return paginator.message
+
+
+async def on_reaction(payload):
+    """Turn the page of a paginated message, for on_raw_reaction_add."""
+    paginator = _paginators.get(payload.message_id)
+    if paginator is None or payload.user_id == paginator.me.id:
+        return
+    if paginator.expires <= time.monotonic():
+        return
+    await paginator.turn(str(payload.emoji))
+
+
+def _start_sweeper():
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.ensure_future(_sweep())
+
+
+async def _sweep():
+    """Close expired paginators, until none are left open."""
+    while _paginators:
+        await asyncio.sleep(min(PAGE_TTL, 5))
+        now = time.monotonic()
+        expired = [p for p in _paginators.values() if p.expires <= now]
+        for paginator in expired:
+            del _paginators[paginator.message.id]
+            stats["expired"] += 1
+        results = await asyncio.gather(
+            *(paginator.close() for paginator in expired), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Failed to close paginator: {result!r}")
+
+
+def split_lines(lines: list, limit=2000) -> list:
+    """Split lines of text into pages of at most `limit` characters.
+
+    Returns the (start, end) range of lines on each page.
+    """
+    pages = []
+    start = 0
+    length = 0
+    for i, line in enumerate(lines):
+        if i > start and length + 1 + len(line) > limit:
+            pages.append((start, i))
+            start = i
+            length = 0
+        length += len(line) + (i > start)
+    if start < len(lines):
+        pages.append((start, len(lines)))
+    return pages
+
+
+def metrics() -> dict:
+    """Get the number of open paginators, and counts of page turns."""
+    return dict(stats, open=len(_paginators))
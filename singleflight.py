@@ -0,0 +1,33 @@
+import asyncio
+
+
+_inflight = {}
+
+# Per key group (the first element of the key): the number of calls, and how
+# many of them were coalesced into an in-flight call.
+stats = {}
+
+
+async def do(key: tuple, fn, *args):
+    """Call the coroutine function fn(*args), coalescing concurrent calls.
+
+    If a call with the same key is already in flight, wait for its result
+    instead of starting a new one. The key is a tuple whose first element
+    names the kind of call, for stats.
+    """
+    group = stats.setdefault(key[0], dict(calls=0, coalesced=0))
+    group["calls"] += 1
+    future = _inflight.get(key)
+    if future is None:
+        future = _inflight[key] = asyncio.ensure_future(fn(*args))
+        future.add_done_callback(lambda future: _forget(key, future))
+    else:
+        group["coalesced"] += 1
+    # shield the shared call, so that one caller being cancelled doesn't
+    # cancel it for the others
+    return await asyncio.shield(future)
+
+
+def _forget(key: tuple, future: asyncio.Future):
+    if _inflight.get(key) is future:
+        del _inflight[key]
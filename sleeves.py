@@ -1,91 +1,79 @@
 import io
-import os
+import time
 import tempfile
 import json
 import random
 
-import aiohttp
 import PIL
 import unitypack
 
+import cache
+import assets
+import workers
+
 
-_assetmanifest = None
-_asset_cache = {}
 _sleeve_names = None
 
 
 async def get_assetmanifest() -> dict:
-    global _assetmanifest
-    if _assetmanifest is not None:
-        return _assetmanifest
-
-    res_ver = os.environ["RES_VER"]
-    url = f"https://shadowverse.akamaized.net/dl/Manifest/{res_ver}/Eng/Windows/sleeve_assetmanifest"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            text = await response.text()
+    return await assets.get_manifest("sleeve")
 
-    ret = {}
-    for line in text.splitlines():
-        fields = line.split(",")
-        if len(fields) < 2:
-            continue
-        [name, hexcode, *_] = fields
 
-        prefix = "card_sleeve_"
-        suffix = ".unity3d"
-        if not name.startswith(prefix) and name.endswith(suffix):
-            continue
-        sleeve_id = name[len(prefix) : -len(suffix)]
-
-        if not sleeve_id.isdigit():
-            continue
-        sleeve_id = int(sleeve_id)
+async def get_asset(sleeve_id: int) -> io.BytesIO:
+    png = await _get_asset_png(sleeve_id)
+    if png is None:
+        return None
+    return io.BytesIO(png)
 
-        ret[sleeve_id] = hexcode
-
-    _assetmanifest = ret
-    return ret
 
+async def _get_asset_png(sleeve_id: int) -> bytes:
+    hexcode = await assets.get_hexcode("sleeve", sleeve_id)
+    if hexcode is None:
+        return None
 
-async def get_asset(sleeve_id: int) -> io.BytesIO:
-    data = _asset_cache.get(sleeve_id)
+    if cache.asset_cache_rendered:
+        png = cache.asset_cache.get(("sleeve", hexcode))
+        if png is not None:
+            return png
 
+    data = await assets.get_resource(hexcode)
     if data is None:
-        manifest = await get_assetmanifest()
+        return None
+
+    info = assets.bundle_info.get(hexcode)
+    png, index, seconds = await workers.run(render_asset, data, info and info["index"])
+    assets.record_decode(hexcode, index, seconds)
+    if cache.asset_cache_rendered and png is not None:
+        cache.asset_cache.put(("sleeve", hexcode), png)
+    return png
 
-        hexcode = manifest.get(sleeve_id)
-        if hexcode is None:
-            return None
 
-        url = f"https://shadowverse.akamaized.net/dl/Resource/Eng/Windows/{hexcode}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = _asset_cache[sleeve_id] = await response.read()
+def render_asset(data: bytes, index: list = None) -> tuple:
+    """Extract a sleeve's art from an asset bundle, as PNG bytes.
 
+    Returns the PNG, the bundle's index (built if not given), and the time
+    taken. Runs in a worker process.
+    """
+    start = time.perf_counter()
     data = io.BytesIO(data)
     data.name = ""
     bundle = unitypack.load(data)
+    if index is None:
+        index = assets.index_bundle(bundle)
 
     image = None
-    for asset in bundle.assets:
-        for _, obj in asset.objects.items():
-            if obj.type == "Texture2D":
-                d = obj.read()
-                image = d.image
-                break
-        if image is not None:
+    for entry in index:
+        if entry["type"] == "Texture2D":
+            image = assets.read_object(bundle, entry).image
             break
 
-    if image is None:
-        return None
-
-    ret = io.BytesIO()
-    image = image.transpose(PIL.Image.FLIP_TOP_BOTTOM).resize((764, 1024))
-    image.save(ret, format="png")
-    ret.seek(0)
-
-    return ret
+    png = None
+    if image is not None:
+        ret = io.BytesIO()
+        image = image.transpose(PIL.Image.FLIP_TOP_BOTTOM).resize((764, 1024))
+        image.save(ret, format="png")
+        png = ret.getvalue()
+    return png, index, time.perf_counter() - start
 
 
 async def get_sleeve_names() -> dict:
@@ -93,58 +81,12 @@ async def get_sleeve_names() -> dict:
     if _sleeve_names is not None:
         return _sleeve_names
 
-    sleeve_master = None
-    sleevenametext = None
-
-    res_ver = os.environ["RES_VER"]
-    url = f"https://shadowverse.akamaized.net/dl/Manifest/{res_ver}/Eng/Windows/master_assetmanifest"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            text = await response.text()
-
-    for line in text.splitlines():
-        fields = line.split(",")
-        if len(fields) < 2:
-            continue
-        [name, hexcode, *_] = fields
-
-        if name == "master_sleeve_master.unity3d":
-            url = f"https://shadowverse.akamaized.net/dl/Resource/Eng/Windows/{hexcode}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    data = await response.read()
-
-            data = io.BytesIO(data)
-            data.name = ""
-            bundle = unitypack.load(data)
-            for asset in bundle.assets:
-                for _, obj in asset.objects.items():
-                    if obj.type == "TextAsset":
-                        d = obj.read()
-                        if d.name == "sleeve_master":
-                            sleeve_master = d.script
-                            break
-                if sleeve_master is not None:
-                    break
-
-        elif name == "master_sleevenametext.unity3d":
-            url = f"https://shadowverse.akamaized.net/dl/Resource/Eng/Windows/{hexcode}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    data = await response.read()
-
-            data = io.BytesIO(data)
-            data.name = ""
-            bundle = unitypack.load(data)
-            for asset in bundle.assets:
-                for _, obj in asset.objects.items():
-                    if obj.type == "TextAsset":
-                        d = obj.read()
-                        if d.name == "sleevenametext":
-                            sleevenametext = d.script
-                            break
-                if sleevenametext is not None:
-                    break
+    sleeve_master = await _get_text_asset(
+        "master_sleeve_master.unity3d", "sleeve_master"
+    )
+    sleevenametext = await _get_text_asset(
+        "master_sleevenametext.unity3d", "sleevenametext"
+    )
 
     sleevenametext = json.loads(sleevenametext)
     sleevenametext = sleevenametext["sleevenametext"]["Eng"]
@@ -165,6 +107,24 @@ async def get_sleeve_names() -> dict:
     return ret
 
 
+async def _get_text_asset(bundle_name: str, asset_name: str) -> str:
+    hexcode = await assets.get_hexcode("master", bundle_name)
+    if hexcode is None:
+        return None
+    data = await assets.get_resource(hexcode)
+
+    data = io.BytesIO(data)
+    data.name = ""
+    bundle = unitypack.load(data)
+    for asset in bundle.assets:
+        for _, obj in asset.objects.items():
+            if obj.type == "TextAsset":
+                d = obj.read()
+                if d.name == asset_name:
+                    return d.script
+    return None
+
+
 async def find_sleeve(query) -> (int, str):
     sleeve_names = await get_sleeve_names()
     for sleeve_id, sleeve_name in sleeve_names.items():
@@ -0,0 +1,54 @@
+import asyncio
+
+import assets
+
+
+class FakeContent:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self.body), 7):
+            yield self.body[i : i + 7]
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.content = FakeContent(body)
+
+    def raise_for_status(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url):
+        return FakeResponse(self.body)
+
+
+def test_download_manifest(monkeypatch):
+    body = (
+        b"card_1000110100.unity3d,aaaa,1\r\n"
+        b"card_1000110101.unity3d,bbbb,1\r\n"
+        b"card_sleeve_5000.unity3d,cccc,1\r\n"
+        b"card_x0.unity3d,dddd,1\r\n"
+        b"bad line\r\n"
+        b"card_1000120100.unity3d,eeee"
+    )
+    monkeypatch.setenv("RES_VER", "1")
+    monkeypatch.setattr(assets.http_client, "session", lambda: FakeSession(body))
+    # only names with both the prefix and the suffix are base card art, and
+    # evolved art (ending in "1.unity3d") mustn't overwrite it
+    card = asyncio.run(assets._download_manifest("card"))
+    assert card == {100011010: "aaaa", 100012010: "eeee"}
+    master = asyncio.run(assets._download_manifest("master"))
+    assert len(master) == 5
+    assert master["card_1000110101.unity3d"] == "bbbb"
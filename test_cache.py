@@ -0,0 +1,162 @@
+import os
+
+import pytest
+
+import cache
+
+
+class FakeClock:
+    now = 1000.0
+
+    @classmethod
+    def monotonic(cls):
+        return cls.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(cache, "time", FakeClock)
+    FakeClock.now = 1000.0
+    return FakeClock
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "cache_dir", str(tmp_path))
+    return tmp_path
+
+
+def test_lru_maxsize():
+    lru = cache.LRUCache(2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    assert lru.get("a") == 1
+    lru.put("c", 3)
+    # "b" was used least recently
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert len(lru) == 2
+
+
+def test_lru_maxbytes():
+    lru = cache.LRUCache(maxbytes=10)
+    lru.put("a", b"xxxx")
+    lru.put("b", b"xxxx")
+    lru.put("c", b"xxxx")
+    assert lru.get("a") is None
+    assert lru.stats()["bytes"] == 8
+    lru.put("d", b"x" * 10)
+    assert len(lru) == 1
+    assert lru.stats()["bytes"] == 10
+    lru.put("e", b"x" * 11)
+    assert len(lru) == 0
+    assert lru.stats()["bytes"] == 0
+
+
+def test_lru_sizeof():
+    lru = cache.LRUCache(maxbytes=10, sizeof=lambda value: value["size"])
+    lru.put("a", dict(size=6))
+    lru.put("b", dict(size=6))
+    assert lru.get("a") is None
+    assert lru.stats()["bytes"] == 6
+
+
+def test_lru_replace():
+    lru = cache.LRUCache(maxbytes=10)
+    lru.put("a", b"xxxx")
+    lru.put("b", b"xxxx")
+    lru.put("a", b"xx")
+    assert lru.stats()["bytes"] == 6
+    assert lru.get("a") == b"xx"
+    lru.put("a", b"xxxxxx")
+    assert lru.stats()["bytes"] == 10
+    assert len(lru) == 2
+    lru.clear()
+    assert lru.stats()["bytes"] == 0
+
+
+def test_lru_ttl(clock):
+    lru = cache.LRUCache(maxbytes=10, ttl=60)
+    lru.put("a", b"xxxx")
+    clock.now += 30
+    lru.put("b", b"xxxx")
+    clock.now += 29
+    assert lru.get("a") == b"xxxx"
+    clock.now += 1
+    # expiry counts from insertion, not from the last use
+    assert lru.get("a") is None
+    assert lru.get("b") == b"xxxx"
+    assert lru.stats()["bytes"] == 4
+    lru.put("b", b"xxxx")
+    clock.now += 59
+    assert lru.get("b") == b"xxxx"
+
+
+def test_lru_stats():
+    lru = cache.LRUCache(2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.get("a")
+    lru.get("a")
+    lru.get("c")
+    lru.put("c", 3)
+    lru.put("d", 4)
+    assert lru.stats() == dict(entries=2, maxsize=2, hits=2, misses=1, evictions=2)
+
+
+def set_mtime(disk, key, mtime):
+    os.utime(disk._path(key), (mtime, mtime))
+
+
+def test_disk_evict(cache_dir):
+    disk = cache.DiskCache("test", maxbytes=10)
+    disk.put("a", b"xxxx")
+    disk.put("b/c", b"xxxx")
+    set_mtime(disk, "a", 1000)
+    set_mtime(disk, "b/c", 2000)
+    disk.put("d", b"xxxx")
+    assert disk.get("a") is None
+    assert disk.get("b/c") == b"xxxx"
+    assert disk.get("d") == b"xxxx"
+    assert disk.stats()["bytes"] == 8
+    assert sorted(os.listdir(cache_dir / "test")) == ["b%2Fc", "d"]
+
+
+def test_disk_get_refreshes(cache_dir):
+    disk = cache.DiskCache("test", maxbytes=10)
+    disk.put("a", b"xxxx")
+    disk.put("b", b"xxxx")
+    set_mtime(disk, "a", 1000)
+    set_mtime(disk, "b", 2000)
+    assert disk.get("a") == b"xxxx"
+    disk.put("c", b"xxxx")
+    assert disk.get("b") is None
+    assert disk.get("a") == b"xxxx"
+
+
+def test_disk_scan(cache_dir):
+    disk = cache.DiskCache("test", maxbytes=10)
+    disk.put("a", b"xxxx")
+    disk.put("b", b"xxxx")
+    # a new instance finds the files already on disk
+    disk = cache.DiskCache("test", maxbytes=10)
+    assert disk.stats()["bytes"] == 8
+    set_mtime(disk, "a", 1000)
+    set_mtime(disk, "b", 2000)
+    disk.put("b", b"xx")
+    disk.put("c", b"xxxx")
+    assert disk.stats()["bytes"] == 10
+    assert disk.get("a") == b"xxxx"
+
+
+def test_disk_retain(cache_dir):
+    disk = cache.DiskCache("test", maxbytes=100)
+    for key in ["a", "b", "c/d"]:
+        disk.put(key, b"xxxx")
+    assert disk.retain(["b", "c/d", "e"]) == 1
+    assert disk.get("a") is None
+    assert disk.get("c/d") == b"xxxx"
+    assert disk.stats() == dict(
+        entries=2, bytes=8, maxbytes=100, hits=1, misses=1, evictions=0
+    )
@@ -1,3 +1,8 @@
+import json
+import random
+import asyncio
+import difflib
+
 import pytest
 
 import card_data
@@ -307,3 +312,223 @@ def test_absorbtion(cards):
 
 def test_falconeer(cards):
     assert find(cards, "storied falconeer")[:1] == ["Storied Falconer"]
+
+
+def keyword_match(card, query):
+    fields = card_data.keyword_fields(card)
+    lowered_query = [q.lower() for q in query]
+    for query_word in query:
+        word_found = False
+        for field in fields:
+            if any(
+                query_word.lower() == word
+                and field.lower() == exception
+                and guard not in lowered_query
+                for (word, exception, guard) in card_data.keyword_exceptions
+            ):
+                continue
+            if query_word in (field.lower() if query_word.islower() else field):
+                word_found = True
+                break
+        if not word_found:
+            return False
+    return True
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "6pp shadow gold spell",
+        "earth sigil",
+        "storm",
+        "storm rivayle",
+        "Storm omen",
+        "2/2 Ward",
+        "leader",
+    ],
+)
+def test_keyword_index(cards, query):
+    query = query.split()
+    expected = [
+        card["card_id"]
+        for card in cards
+        if card["card_name"] is not None and keyword_match(card, query)
+    ]
+    results = [card["card_id"] for card in card_data.find_by_keywords(cards, query)]
+    assert sorted(results) == sorted(expected)
+
+
+def difflib_match_score(card_name, query):
+    if query.islower():
+        card_name = card_name.lower()
+    s = difflib.SequenceMatcher(str.isspace, query, card_name, autojunk=False)
+    match_size = 0
+    match_cost = len(query)
+    pos = 0
+    for block in s.get_matching_blocks():
+        match_size += block.size
+        num_unmatched_words = len(card_name[pos : block.b].split())
+        if block.b < len(card_name):
+            match_cost += num_unmatched_words
+        else:
+            if num_unmatched_words > 0:
+                match_cost += 1
+            if (
+                num_unmatched_words > 1
+                and pos < len(card_name)
+                and not card_name[pos].isspace()
+                and not card_name[pos] == ","
+            ):
+                match_cost += 1
+        pos = block.b + block.size
+    return match_size / match_cost
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["medusa", "neph alt", "arriet,", "XI.", "elf queen abundant life", "Heaven"],
+)
+def test_name_match_score(cards, query):
+    for card in cards:
+        card_name = card["card_name"]
+        if card_name is None:
+            continue
+        assert card_data.name_match_score(card_name, query) == difflib_match_score(
+            card_name, query
+        )
+
+
+def test_name_match_score_random():
+    rng = random.Random(0)
+    chars = "ab ,\tA'　"
+    for _ in range(5000):
+        card_name = "".join(rng.choice(chars) for _ in range(rng.randint(0, 12)))
+        query = "".join(rng.choice(chars) for _ in range(rng.randint(1, 8)))
+        assert card_data.name_match_score(card_name, query) == difflib_match_score(
+            card_name, query
+        )
+
+
+def test_predicates(cards):
+    results = card_data.find(cards, "dragoncraft cost>=7 atk<5".split())
+    assert results
+    for card in results:
+        assert card["clan"] == 4 and card["cost"] >= 7 and card["atk"] < 5
+    results = card_data.find(cards, "set:rotation craft:haven type:amulet".split())
+    assert results
+    for card in results:
+        assert card["format_type"] == 1 and card["clan"] == 7
+        assert card["char_type"] in (2, 3)
+    # a set name takes precedence over a format name with the same prefix
+    results = card_data.find(cards, "set:ro".split())
+    assert results
+    assert all(card["card_set_id"] == 10025 for card in results)
+    # not numbers, so these are searched as keywords
+    for query in ["cost>--5", "atk<²", "life>٣"]:
+        card_data.find(cards, [query])
+
+
+def eager_merge(name_results, keyword_results):
+    if not keyword_results:
+        return name_results
+    result_ids = set(card["card_id"] for card in keyword_results)
+    results = []
+    for card in name_results + keyword_results:
+        if card["card_id"] in result_ids:
+            result_ids.remove(card["card_id"])
+            results += [card]
+    return results
+
+
+@pytest.mark.parametrize("keyword_count", [0, 1, 10, 40])
+def test_results(keyword_count):
+    rng = random.Random(keyword_count)
+    cards = [dict(card_id=i) for i in range(60)]
+    name_matches = [((rng.random(), i), i) for i in rng.sample(range(60), 30)]
+    keyword_results = [cards[i] for i in sorted(rng.sample(range(60), keyword_count))]
+    name_results = [cards[i] for (key, i) in sorted(name_matches)]
+    expected = eager_merge(name_results, keyword_results)
+
+    def results():
+        return card_data.Results(cards, name_matches, keyword_results)
+
+    assert len(results()) == len(expected)
+    assert list(results()) == expected
+    for i in range(-len(expected) - 2, len(expected) + 2):
+        if -len(expected) <= i < len(expected):
+            assert results()[i] == expected[i]
+        else:
+            with pytest.raises(IndexError):
+                results()[i]
+    bounds = [None, -70, -5, 0, 3, 25, 70]
+    for start in bounds:
+        for stop in bounds:
+            for step in [None, 2, -1, -3]:
+                assert results()[start:stop:step] == expected[start:stop:step]
+
+
+info_cards = [
+    dict(
+        card_id=100011010,
+        base_card_id=100011010,
+        card_set_id=10000,
+        card_name="Σίσυφος 😀",
+        cost=2,
+        skill_disc='Fanfare: "cards": [ ] , {ü}',
+        tokens="",
+    ),
+    dict(
+        card_id=700011010,
+        base_card_id=100011010,
+        card_set_id=70001,
+        card_name="Σίσυφος 😀",
+        cost=2,
+        skill_disc='Fanfare: "cards": [ ] , {ü}',
+    ),
+    dict(card_id=100011020, base_card_id=100011020, card_set_id=10000, cost=None),
+]
+info_body = json.dumps(
+    {"data_headers": {"result": 1}, "data": {"cards": info_cards, "errors": []}},
+    ensure_ascii=False,
+    indent=1,
+).encode()
+
+
+class FakeContent:
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i : i + self.chunk_size]
+
+
+class FakeResponse:
+    def __init__(self, body, chunk_size):
+        self.content = FakeContent(body, chunk_size)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, len(info_body)])
+def test_read_cards(chunk_size):
+    response = FakeResponse(info_body, chunk_size)
+    cards = asyncio.run(card_data._read_cards(response))
+    assert len(cards) == len(info_cards)
+    for card, info in zip(cards, info_cards):
+        for field in card.keys():
+            if field == "base_card_set_id":
+                assert card[field] == 10000
+            else:
+                assert card[field] == info.get(field)
+    assert cards[0]["skill_disc"] is cards[1]["skill_disc"]
+
+
+# cut off before the card list, in a multibyte character, and in the last card
+@pytest.mark.parametrize(
+    "length",
+    [0, 40, info_body.index("😀".encode()) + 2, info_body.index(b'"cost": null')],
+)
+def test_read_cards_truncated(length):
+    response = FakeResponse(info_body[:length], 7)
+    with pytest.raises(ValueError):
+        asyncio.run(card_data._read_cards(response))
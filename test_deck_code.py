@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+import deck_code
+
+
+cards = [
+    dict(card_id=101014010, card_name="Goblin"),
+    dict(card_id=900511010, card_name="Bellringer Angel"),
+]
+# Written out rather than encoded with deck_code.HASH_ALPHABET, so that a wrong
+# alphabet or digit order fails the tests
+deck_hash = "3.1.61lDW.RHbky.61lDW.RHbky.61lDW.RHbky"
+
+
+def test_decode_hash():
+    assert deck_code.decode_hash(deck_hash) == (3, 1, [101014010, 900511010] * 3)
+    # 5*64^4 + 61*64^3 + 32*64^2 + 48*64 + 2: the most significant digit first
+    assert deck_code.decode_hash("1.8.5ZwM2.RFhg2.0000_") == (
+        1,
+        8,
+        [100011010, 900011010, 63],
+    )
+    with pytest.raises(ValueError):
+        deck_code.decode_hash("3.1.61lD")
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        (deck_hash, deck_hash),
+        (f"https://shadowverse-portal.com/deck/{deck_hash}?lang=en", deck_hash),
+        ("abcd", None),
+    ],
+)
+def test_parse_hash(text, expected):
+    assert deck_code.parse_hash(text) == expected
+
+
+def test_decode_deck():
+    deck = deck_code.decode_deck(deck_hash, cards)
+    assert deck["clan"] == 1
+    assert [card["card_name"] for card in deck["cards"]] == [
+        "Goblin",
+        "Bellringer Angel",
+    ] * 3
+    assert deck_code.decode_deck(deck_hash, cards[:1]) is None
+    assert deck_code.decode_deck("3.1.!!!!!", cards) is None
+
+
+class FakeResponse:
+    def __init__(self, json):
+        self._json = json
+
+    async def json(self):
+        return self._json
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, deck):
+        self.deck = deck
+
+    def get(self, url):
+        return FakeResponse({"data": {"deck": self.deck, "errors": []}})
+
+
+@pytest.mark.parametrize(
+    "card_ids,mismatched", [([101014010, 900511010] * 3, 0), ([101014010] * 6, 1)]
+)
+def test_download_checks_decoder(monkeypatch, card_ids, mismatched):
+    deck = dict(clan=1, cards=[dict(card_id=card_id) for card_id in card_ids])
+    monkeypatch.setattr(deck_code.http_client, "session", lambda: FakeSession(deck))
+    monkeypatch.setattr(
+        deck_code, "decode_stats", dict(decoded=0, downloaded=0, mismatched=0)
+    )
+    result = asyncio.run(deck_code._download(deck_hash))
+    assert result == {"hash": deck_hash, "deck": deck}
+    assert deck_code.decode_stats["downloaded"] == 1
+    assert deck_code.decode_stats["mismatched"] == mismatched
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+import paginator
+
+
+class FakeUser:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeMessage:
+    def __init__(self, id, **kwargs):
+        self.id = id
+        self.contents = [kwargs]
+        self.reactions = []
+
+    async def edit(self, **kwargs):
+        self.contents.append(kwargs)
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji, user):
+        self.reactions.remove(emoji)
+
+
+class FakeContext:
+    me = FakeUser(1)
+
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, **kwargs):
+        message = FakeMessage(100 + len(self.messages), **kwargs)
+        self.messages.append(message)
+        return message
+
+
+class FakePayload:
+    def __init__(self, message, emoji, user_id=2):
+        self.message_id = message.id
+        self.emoji = emoji
+        self.user_id = user_id
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(paginator, "_paginators", {})
+    monkeypatch.setattr(paginator, "_sweeper", None)
+    monkeypatch.setattr(paginator, "stats", dict(opened=0, turns=0, expired=0))
+
+
+def render(page):
+    return dict(content=f"page {page}")
+
+
+def test_send():
+    async def main():
+        ctx = FakeContext()
+        message = await paginator.send(ctx, 1, render)
+        assert message.contents == [dict(content="page 0")]
+        assert message.reactions == []
+        assert not paginator._paginators
+
+        message = await paginator.send(ctx, 3, render)
+        assert message.reactions == [paginator.PREV, paginator.NEXT]
+        assert paginator._paginators[message.id].message is message
+        assert paginator.metrics() == dict(opened=1, turns=0, expired=0, open=1)
+
+    asyncio.run(main())
+
+
+def test_turn():
+    rendered = []
+
+    def render_once(page):
+        rendered.append(page)
+        return render(page)
+
+    async def main():
+        ctx = FakeContext()
+        message = await paginator.send(ctx, 3, render_once)
+        for emoji in [
+            paginator.PREV,
+            paginator.NEXT,
+            paginator.NEXT,
+            paginator.NEXT,
+            paginator.PREV,
+            "👍",
+            paginator.NEXT,
+        ]:
+            await paginator.on_reaction(FakePayload(message, emoji))
+        contents = [kwargs["content"] for kwargs in message.contents]
+        assert contents == ["page 0", "page 1", "page 2", "page 1", "page 2"]
+        # pages are rendered once, and turning past either end does nothing
+        assert rendered == [0, 1, 2]
+        assert paginator.stats["turns"] == 4
+
+    asyncio.run(main())
+
+
+def test_ignored_reactions():
+    async def main():
+        ctx = FakeContext()
+        message = await paginator.send(ctx, 3, render)
+        other = FakeMessage(999)
+        await paginator.on_reaction(FakePayload(message, paginator.NEXT, user_id=1))
+        await paginator.on_reaction(FakePayload(other, paginator.NEXT))
+        assert len(message.contents) == 1
+
+        paginator._paginators[message.id].expires = 0
+        await paginator.on_reaction(FakePayload(message, paginator.NEXT))
+        assert len(message.contents) == 1
+
+    asyncio.run(main())
+
+
+def test_expire(monkeypatch):
+    monkeypatch.setattr(paginator, "PAGE_TTL", 0.1)
+
+    async def main():
+        ctx = FakeContext()
+        message = await paginator.send(ctx, 3, render)
+        await asyncio.sleep(0.06)
+        await paginator.on_reaction(FakePayload(message, paginator.NEXT))
+        # turning the page keeps the message open past the first sweep
+        await asyncio.sleep(0.06)
+        assert message.id in paginator._paginators
+        await asyncio.sleep(0.2)
+        assert not paginator._paginators
+        assert message.reactions == []
+        assert paginator.stats["expired"] == 1
+        await paginator._sweeper
+
+    asyncio.run(main())
+
+
+def test_split_lines():
+    assert paginator.split_lines([]) == []
+    assert paginator.split_lines(["a", "b", "c"]) == [(0, 3)]
+    lines = ["a" * 1000, "b" * 999, "c", "d" * 10]
+    assert paginator.split_lines(lines) == [(0, 2), (2, 4)]
+    assert paginator.split_lines(lines, limit=1000) == [(0, 1), (1, 2), (2, 4)]
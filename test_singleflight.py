@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import singleflight
+
+
+def test_coalesce():
+    calls = []
+
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def main():
+        results = await asyncio.gather(
+            *(singleflight.do(("test_coalesce", 1), fetch, 1) for _ in range(3)),
+            singleflight.do(("test_coalesce", 2), fetch, 2),
+        )
+        assert results == [2, 2, 2, 4]
+        assert calls == [1, 2]
+        assert not singleflight._inflight
+        # a later call starts over
+        assert await singleflight.do(("test_coalesce", 1), fetch, 1) == 2
+        assert calls == [1, 2, 1]
+
+    asyncio.run(main())
+    assert singleflight.stats["test_coalesce"] == dict(calls=5, coalesced=2)
+
+
+def test_exception():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def main():
+        results = await asyncio.gather(
+            *(singleflight.do(("test_exception",), fail) for _ in range(3)),
+            return_exceptions=True,
+        )
+        assert [type(result) for result in results] == [ValueError] * 3
+        assert not singleflight._inflight
+
+    asyncio.run(main())
+
+
+def test_cancel():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(singleflight.do(("test_cancel",), fetch))
+        second = asyncio.ensure_future(singleflight.do(("test_cancel",), fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second == "done"
+        assert not singleflight._inflight
+
+    asyncio.run(main())
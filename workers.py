@@ -0,0 +1,91 @@
+import os
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 2))
+# Jobs submitted to the pool at once; further callers wait for a slot.
+WORKER_QUEUE = int(os.environ.get("WORKER_QUEUE", 8))
+WORKER_TIMEOUT = float(os.environ.get("WORKER_TIMEOUT", 60))
+
+_pool = None
+_slots = None
+
+stats = dict(jobs=0, timeouts=0, failures=0, recycled=0)
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # fork rather than spawn, since main.py starts the bot on import
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=WORKER_PROCESSES,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+    return _pool
+
+
+async def run(fn, *args):
+    """Run fn(*args) in a worker process and return its result.
+
+    fn and its arguments must be picklable, so fn should be a module-level
+    function. Raises asyncio.TimeoutError if the job doesn't finish within
+    WORKER_TIMEOUT seconds, including time spent waiting for a slot.
+    """
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(WORKER_QUEUE)
+    stats["jobs"] += 1
+    job = {}
+    try:
+        return await asyncio.wait_for(_submit(job, fn, *args), WORKER_TIMEOUT)
+    except asyncio.TimeoutError:
+        # the job may be hung; replace its pool so it can't hold a slot forever
+        stats["timeouts"] += 1
+        _recycle(job.get("pool"))
+        raise
+    except concurrent.futures.process.BrokenProcessPool:
+        # a worker died; start a fresh pool for the next job
+        stats["failures"] += 1
+        _recycle(job.get("pool"))
+        raise
+
+
+async def _submit(job: dict, fn, *args):
+    loop = asyncio.get_running_loop()
+    slots = _slots
+    await slots.acquire()
+    try:
+        job["pool"] = _get_pool()
+        future = job["pool"].submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    # hold the slot until the job actually finishes, even if the caller has
+    # timed out, so the number of jobs in the pool stays bounded
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(slots.release))
+    return await asyncio.wrap_future(future)
+
+
+def _recycle(pool):
+    """Kill the processes of a pool, if it is still the current one, and start
+    over with a fresh pool and slots."""
+    global _pool, _slots
+    if pool is None or pool is not _pool:
+        return
+    stats["recycled"] += 1
+    _pool = None
+    _slots = asyncio.Semaphore(WORKER_QUEUE)
+    processes = list((pool._processes or {}).values())
+    for process in processes:
+        process.kill()
+    pool.shutdown(wait=False)
+
+
+def shutdown():
+    """Stop the worker processes."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None